@@ -1,12 +1,22 @@
 #!/usr/bin/env python
 
 import argparse
+import hashlib
+import heapq
+import mmap
+import multiprocessing
 import os
 import re
+import shutil
+import struct
 import sys
 import tempfile
+from functools import partial
+from itertools import chain, groupby, islice
+from operator import itemgetter
 
 import matplotlib.pyplot as plt
+import numpy as np
 
 from ortholotree import config
 
@@ -23,6 +33,22 @@ def define_arguments():
                         help="specify the filename to save results to")
     parser.add_argument("-d", "--directory", type=str,
                         help="specify the directory to save results to")
+    parser.add_argument("-t", "--threads", type=int, default=1,
+                        help="number of blast result files to read at once (default = 1)")
+    parser.add_argument("--cache_dir", type=str,
+                        help="""directory to keep the parsed best hits of each blast file in
+                        (default = the directory of each blast file), and to spill best
+                        hits to with --memory_budget (default = the temp directory)""")
+    parser.add_argument("--no_cache", action='store_true', default=False,
+                        help="always reparse the blast files")
+    parser.add_argument("-M", "--memory_budget", type=int,
+                        help="""approximate memory (in MB) to hold best hits in. Larger
+                        results are sorted into runs on disk and merged (the cache is
+                        not used)""")
+    parser.add_argument("-C", "--cutoffs", type=str,
+                        help="""comma-separated list of scores to also count taxa at, as
+                        though each were the cutoff for unknown hits. Writes one table
+                        and one chart for all of them""")
 
     # data file options:
     parser.add_argument("blast_results", type=str, nargs='+',
@@ -32,7 +58,9 @@ def define_arguments():
                         help="""location of swissprot taxa definition file.""")
     parser.add_argument("--taxa_groups", type=str,
                         default='/Volumes/antqueen/booster/PRO_Odontomachus/swissprot_classes.csv',
-                        help="""location of the swissprot taxa classification file.""")
+                        help="""location of the swissprot taxa classification file, of
+                        'name,parent' lines giving the taxa group each species code or
+                        taxa group belongs to (added to the built-in taxonomy).""")
 
     # select ant subfamily:
     parser.add_argument("--ponerines", action='store_true',
@@ -422,6 +450,484 @@ def get_taxa_groups():
 
 
 
+# the built-in taxonomy: the parent of each taxa group used by get_taxa_groups()
+TAXA_PARENTS = { "Ponerines":"Ants", "Myrmecines":"Ants", "Formicines":"Ants",
+                 "Ants":"Hymenoptera", "Hymenoptera":"Insecta", "Insecta":"Arthropods",
+                 "Arthropods":"Ecdysozoa", "Ecdysozoa":"Protostome",
+                 "Protostome":"Bilateria", "Bilateria":"Metazoa", "Metazoa":"Eukaryotes",
+                 "Eukaryotes":"Life",
+                }
+
+# first column names of a taxa classification file header:
+TAXA_HEADERS = ('species', 'code', 'species_code', 'name', 'taxon', 'taxa', 'child')
+
+def load_taxa_parents(taxa_f):
+    """
+    reads a taxa classification file, in which each line is 'name,parent' (a species code
+    or taxa group, and the taxa group it belongs to), over the built-in taxonomy. Blank
+    lines and lines starting with '#' are skipped. The first line is taken to be a header
+    (such as 'species,class') and skipped if its first name is a column name (lower case,
+    or in TAXA_HEADERS) and neither of its names is used anywhere else in the file or the
+    built-in taxonomy. Other lines that do not look like 'code,group'
+    are skipped with a warning. If the file does not exist, only the built-in taxonomy
+    is returned. Returns a dictionary of name:parent.
+    """
+    parents = dict(TAXA_PARENTS)
+    if not taxa_f or not os.path.exists(taxa_f):
+        return parents
+
+    rows = []
+    handle = open(taxa_f, 'rb')
+    for lineno, line in enumerate(handle):
+        if line.strip() == "" or line.startswith('#'):
+            continue
+        cols = [ c.strip() for c in line.split(',') ]
+        if len(cols) == 2 and re.match(r"^\w+$", cols[0]) and \
+                re.match(r"^\w[\w .-]*$", cols[1]):
+            rows.append((lineno + 1, cols[0], cols[1]))
+        else:
+            sys.stderr.write("warning: %s line %d is not 'code,group': %s\n" % (
+                                                        taxa_f, lineno + 1, line.strip()))
+    handle.close()
+
+    if rows:
+        used = set(TAXA_PARENTS) | set(TAXA_PARENTS.values())
+        used.update(chain(*[ (name, parent) for lineno, name, parent in rows[1:] ]))
+        if rows[0][1] not in used and rows[0][2] not in used and \
+                (rows[0][1].lower() in TAXA_HEADERS or rows[0][1].islower()):
+            rows = rows[1:]
+
+    for lineno, name, parent in rows:
+        parents[name] = parent
+    return parents
+
+class TaxaTree(object):
+    """
+    a taxonomy of taxa groups (and any species codes given a parent), built from a
+    dictionary of name:parent. The ancestors of every node, the node itself included,
+    are precomputed into two flat arrays of (member, ancestor) pairs, so that counts at
+    the leaves can be rolled up to every level of the tree with a single bincount.
+    """
+    def __init__(self, parents):
+        self.nodes = sorted(set(parents) | set(parents.values()))
+        self.index = { n:i for i, n in enumerate(self.nodes) }
+        self.parent = np.array([ self.index.get(parents.get(n), -1) for n in self.nodes ],
+                               dtype=int)
+
+        members = []
+        ancestors = []
+        for i in range(len(self.nodes)):
+            lineage = [i]
+            while self.parent[lineage[-1]] != -1:
+                if self.parent[lineage[-1]] in lineage:
+                    raise ValueError("the taxonomy has a cycle through %s" % self.nodes[i])
+                lineage.append(self.parent[lineage[-1]])
+            members += [i] * len(lineage)
+            ancestors += lineage
+        self.members = np.array(members, dtype=int)
+        self.ancestors = np.array(ancestors, dtype=int)
+        self.depth = np.bincount(self.members, minlength=len(self.nodes)) - 1
+
+    def rollup(self, counts, taxconv={}):
+        """
+        rolls the counts in dictionary counts up to every level of the tree, so each node's
+        count includes those of all its descendants. Names not in the tree are counted at
+        their taxa group in taxconv, and otherwise ignored. Returns a dictionary of
+        node:count.
+        """
+        leaves = np.zeros(len(self.nodes), dtype=int)
+        for name, n in counts.iteritems():
+            if name not in self.index:
+                name = taxconv.get(name)
+            if name in self.index:
+                leaves[self.index[name]] += n
+        rolled = np.bincount(self.ancestors, weights=leaves[self.members],
+                             minlength=len(self.nodes))
+        return { node:int(n) for node, n in zip(self.nodes, rolled) }
+
+    def walk(self, node=None):
+        "yields (node, depth) for every node below node (or the roots), depth first"
+        if node is None:
+            children = [ i for i in range(len(self.nodes)) if self.parent[i] == -1 ]
+        else:
+            children = list(np.flatnonzero(self.parent == self.index[node]))
+        for i in children:
+            yield self.nodes[i], self.depth[i]
+            for descendant in self.walk(self.nodes[i]):
+                yield descendant
+
+class SpeciesDefinitions(object):
+    """
+    a dictionary-like lookup of swissprot species code:definition. The species list
+    (speclist.txt) is parsed once and compiled into a binary index
+    (<speclist>.idx), which later runs memory-map instead of parsing. The index is
+    rebuilt whenever the size or modification time of the species list changes.
+
+    The index holds a header (magic, source size, source mtime, number of codes, code
+    width), the sorted codes as fixed width strings, the offsets of each definition and
+    then the definitions themselves.
+    """
+    magic = 'SPECIDX1'
+    header = struct.Struct('<8sqdqq')
+
+    def __init__(self, speclist_f):
+        self.index_f = speclist_f + '.idx'
+        stat = os.stat(speclist_f)
+        if not self.index_current(stat):
+            try:
+                self.compile(speclist_f, stat)
+            except IOError:
+                # the species list directory is read-only, so keep the index elsewhere:
+                self.index_f = os.path.join(tempfile.gettempdir(), hashlib.md5(
+                        os.path.realpath(speclist_f)).hexdigest() + '.speclist.idx')
+                if not self.index_current(stat):
+                    self.compile(speclist_f, stat)
+        self.load()
+
+    def index_current(self, stat):
+        "checks the index exists and was compiled from a file of this size and mtime"
+        if not os.path.exists(self.index_f):
+            return False
+        index_h = open(self.index_f, 'rb')
+        header = index_h.read(self.header.size)
+        index_h.close()
+        if len(header) < self.header.size:
+            return False
+        magic, size, mtime, n, width = self.header.unpack(header)
+        return magic == self.magic and size == stat.st_size and mtime == stat.st_mtime
+
+    def compile(self, speclist_f, stat):
+        "parses the species list and writes the binary index"
+        definitions = {}
+        prior = None
+        handle = open(speclist_f, 'rb')
+        for line in handle:
+            if line.strip() !=  "" and line[0] != " ":
+                definitions[line.split()[0]] = line.strip()
+                prior = line.split()[0]
+            elif prior is not None:
+                definitions[prior] += line.strip()
+        handle.close()
+
+        codes = sorted(definitions)
+        width = max([ len(c) for c in codes ] + [1])
+        code_array = np.array(codes, dtype='S%d' % width)
+        text = ''.join( definitions[c] for c in codes )
+        offsets = np.cumsum([0] + [ len(definitions[c]) for c in codes ]).astype('<i8')
+
+        index_h = open(self.index_f + '.tmp', 'wb')
+        index_h.write(self.header.pack(self.magic, stat.st_size, stat.st_mtime,
+                                       len(codes), width))
+        index_h.write(code_array.tostring())
+        index_h.write('\0' * (-code_array.nbytes % 8))
+        index_h.write(offsets.tostring())
+        index_h.write(text)
+        index_h.close()
+        os.rename(self.index_f + '.tmp', self.index_f)
+
+    def load(self):
+        "memory-maps the index"
+        index_h = open(self.index_f, 'rb')
+        self.index_mm = mmap.mmap(index_h.fileno(), 0, access=mmap.ACCESS_READ)
+        index_h.close()
+        magic, size, mtime, n, self.width = self.header.unpack(
+                                                    self.index_mm[:self.header.size])
+        pos = self.header.size
+        self.codes = np.frombuffer(self.index_mm, dtype='S%d' % self.width, count=n,
+                                   offset=pos)
+        pos += n * self.width + (-n * self.width % 8)
+        self.offsets = np.frombuffer(self.index_mm, dtype='<i8', count=n + 1, offset=pos)
+        self.text_start = pos + (n + 1) * 8
+
+    def find(self, code):
+        "returns the position of code in the index, or -1 if it is not there"
+        if len(code) > self.width or len(self.codes) == 0:
+            return -1
+        i = np.searchsorted(self.codes, code)
+        if i < len(self.codes) and self.codes[i] == code:
+            return i
+        return -1
+
+    def __contains__(self, code):
+        return self.find(code) != -1
+
+    def __getitem__(self, code):
+        i = self.find(code)
+        if i == -1:
+            raise KeyError(code)
+        return self.index_mm[self.text_start + self.offsets[i]:
+                             self.text_start + self.offsets[i + 1]]
+
+def best_hits(blast_file):
+    """
+    finds the highest scoring hit of each gene in a blast output file. Each line is
+    split only once. Returns three arrays: the genes, their best scores and the
+    subjects of those hits.
+    """
+    best_hit = {}
+    handle = open(blast_file, 'rb')
+    for line in handle:
+        cols = line.split()
+        if not cols:
+            continue
+        score = float(cols[2])
+        gene = cols[0]
+        if gene not in best_hit or score > best_hit[gene][0]:
+            best_hit[gene] = (score, cols[1])
+    handle.close()
+    genes = best_hit.keys()
+    return ( np.array(genes, dtype=str),
+             np.array([ best_hit[g][0] for g in genes ], dtype=float),
+             np.array([ best_hit[g][1] for g in genes ], dtype=str) )
+
+def cached_best_hits(blast_file, cache_dir=None):
+    """
+    returns best_hits(blast_file), loaded from a binary cache of the three arrays
+    (<blast_file>.besthits.npz, in cache_dir if given) when the cache was made from a
+    file with the same path, size and modification time. Otherwise the file is parsed
+    and the cache is saved.
+    """
+    stat = os.stat(blast_file)
+    key = np.array([os.path.realpath(blast_file), str(stat.st_size), repr(stat.st_mtime)])
+    cache_f = os.path.join(cache_dir or os.path.dirname(os.path.realpath(blast_file)),
+                           os.path.basename(blast_file) + '.besthits.npz')
+    if os.path.exists(cache_f):
+        try:
+            cache = np.load(cache_f)
+            if list(cache['key']) == list(key):
+                return cache['genes'], cache['scores'], cache['subjects']
+        except Exception:
+            pass # a damaged cache is treated as missing, and replaced below
+
+    genes, scores, subjects = best_hits(blast_file)
+    try:
+        # write to a temporary file first, so that a cache is never seen half-written:
+        fd, temp_f = tempfile.mkstemp(suffix='.npz', dir=os.path.dirname(cache_f))
+        temp_h = os.fdopen(fd, 'wb')
+        np.savez(temp_h, key=key, genes=genes, scores=scores, subjects=subjects)
+        temp_h.close()
+        os.rename(temp_f, cache_f)
+    except (IOError, OSError):
+        pass # the cache directory is read-only, so parse the file again next time
+    return genes, scores, subjects
+
+def parse_files(parse, blast_files, threads=1):
+    "returns parse(blast_file) for each blast file, parsing threads files at once"
+    if threads > 1:
+        pool = multiprocessing.Pool(threads)
+        try:
+            return pool.map(parse, blast_files)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        return map(parse, blast_files)
+
+def merge_best_hits(partials):
+    """
+    combines the (genes, scores, subjects) best hit arrays of several blast files into
+    the best hit of each gene. Where two files have the same score for a gene, the hit
+    from the earlier file is kept.
+    """
+    genes = np.concatenate([ p[0] for p in partials ])
+    scores = np.concatenate([ p[1] for p in partials ])
+    subjects = np.concatenate([ p[2] for p in partials ])
+
+    # sort by gene, then best score, then file order, and keep the first of each gene:
+    order = np.lexsort((np.arange(len(genes)), -scores, genes))
+    genes = genes[order]
+    first = np.ones(len(genes), dtype=bool)
+    first[1:] = genes[1:] != genes[:-1]
+    return genes[first], scores[order][first], subjects[order][first]
+
+# approximate bytes of memory taken by each gene in a best hit table:
+ROW_BYTES = 256
+# the most runs of best hits open at once when merging them:
+MERGE_FAN_IN = 32
+
+def spill_run(best_hit, run_dir):
+    """
+    writes a best hit table of gene:(score, subject) to a new file in run_dir, sorted by
+    gene, and returns the file's name.
+    """
+    fd, run_f = tempfile.mkstemp(suffix='.run', dir=run_dir)
+    handle = os.fdopen(fd, 'wb')
+    for gene in sorted(best_hit):
+        handle.write("%s\t%r\t%s\n" % (gene, best_hit[gene][0], best_hit[gene][1]))
+    handle.close()
+    return run_f
+
+def best_hit_runs(blast_file, run_dir, max_rows):
+    """
+    finds the highest scoring hit of each gene in a blast output file, as best_hits does,
+    but holding no more than max_rows genes in memory. Each time the table fills it is
+    spilled to run_dir as a run sorted by gene. Returns the runs in the order written.
+    """
+    runs = []
+    best_hit = {}
+    handle = open(blast_file, 'rb')
+    for line in handle:
+        cols = line.split()
+        if not cols:
+            continue
+        score = float(cols[2])
+        gene = cols[0]
+        if gene not in best_hit:
+            if len(best_hit) >= max_rows:
+                runs.append(spill_run(best_hit, run_dir))
+                best_hit = {}
+            best_hit[gene] = (score, cols[1])
+        elif score > best_hit[gene][0]:
+            best_hit[gene] = (score, cols[1])
+    handle.close()
+    if best_hit:
+        runs.append(spill_run(best_hit, run_dir))
+    return runs
+
+def read_run(run_f, rank):
+    "yields the (gene, -score, rank, subject) rows of a run written by spill_run"
+    handle = open(run_f, 'rb')
+    for line in handle:
+        gene, score, subject = line.rstrip('\n').split('\t')
+        yield gene, -float(score), rank, subject
+    handle.close()
+
+def best_of_runs(runs):
+    """
+    merges runs written by spill_run (given in file order) into the best hit of each
+    gene, yielding (gene, score, subject) in gene order. As with merge_best_hits, where
+    two runs have the same score for a gene, the hit from the earlier run is kept. Only
+    one row of each run is held in memory at a time.
+    """
+    streams = [ read_run(run_f, rank) for rank, run_f in enumerate(runs) ]
+    for gene, hits in groupby(heapq.merge(*streams), key=itemgetter(0)):
+        gene, score, rank, subject = next(hits)
+        yield gene, -score, subject
+
+def merge_best_hit_runs(runs, run_dir, fan_in=MERGE_FAN_IN):
+    """
+    merges the runs written by best_hit_runs (given in file order) into the best hit of
+    each gene, as best_of_runs does, but with no more than fan_in runs open at once. While
+    there are more runs than that, each group of fan_in consecutive runs is merged into a
+    single run in run_dir, and the group is deleted. Keeping the groups in file order
+    keeps the earlier run winning ties.
+    """
+    while len(runs) > fan_in:
+        merged = []
+        for i in range(0, len(runs), fan_in):
+            fd, run_f = tempfile.mkstemp(suffix='.run', dir=run_dir)
+            handle = os.fdopen(fd, 'wb')
+            for gene, score, subject in best_of_runs(runs[i:i + fan_in]):
+                handle.write("%s\t%r\t%s\n" % (gene, score, subject))
+            handle.close()
+            for old_f in runs[i:i + fan_in]:
+                os.remove(old_f)
+            merged.append(run_f)
+        runs = merged
+    return best_of_runs(runs)
+
+def intern_species(subjects, definitions, taxconv):
+    """
+    finds the species code of each subject and interns them to integers. The species
+    code of a subject is the part after its last '_' if that is a swissprot species,
+    otherwise the part before its first '|'. Only the distinct subjects are handled in
+    python. Returns the species, the species index of each subject, the taxa groups
+    (ending with 'unknown') and the group index of each species.
+    """
+    distinct, subject_idx = np.unique(subjects, return_inverse=True)
+    codes = []
+    for subject in distinct:
+        metaz = subject.split('_')[-1]
+        if metaz in definitions:
+            codes.append(metaz)
+        else:
+            codes.append(subject.split('|')[0])
+    species, species_idx = np.unique(np.array(codes, dtype=str), return_inverse=True)
+
+    groups = sorted(set(taxconv.values())) + ['unknown']
+    group_lookup = np.array([ groups.index(taxconv.get(sp, 'unknown')) for sp in species ],
+                            dtype=int)
+    return species, species_idx[subject_idx], groups, group_lookup
+
+def classify_hits(scores, subjects, definitions, taxconv, cutoff=70, interned=None):
+    """
+    counts best hits by species and by taxa group. Hits scoring below cutoff are counted
+    as unknown. The species codes of the hits are interned to integers, and mapped to
+    taxa groups through a lookup array, so that all hits can be counted with bincount.
+    Returns dictionaries of species:count (including 'unknown') and taxa group:count.
+    If the result of intern_species for these subjects is given as interned, it is used
+    instead of interning them again.
+    """
+    if interned is None:
+        interned = intern_species(subjects, definitions, taxconv)
+    species, hit_species, groups, group_lookup = interned
+    accepted = scores >= cutoff
+    species_counts = np.bincount(hit_species[accepted], minlength=len(species))
+    group_counts = np.bincount(group_lookup[hit_species[accepted]], minlength=len(groups))
+
+    results = { sp:int(n) for sp, n in zip(species, species_counts) if n > 0 }
+    results['unknown'] = int(len(scores) - accepted.sum())
+    taxcount = { g:int(n) for g, n in zip(groups, group_counts) }
+    taxcount['unknown'] += results['unknown']
+    return results, taxcount
+
+def sweep_cutoffs(scores, subjects, definitions, taxconv, cutoffs, interned=None):
+    """
+    counts best hits by taxa group at each of several score cutoffs in one pass. The
+    scores are sorted once, the hits between each pair of consecutive cutoffs are found
+    with searchsorted and counted by group, and the count at each cutoff is the sum of
+    the counts above it. Hits below a cutoff are counted as unknown. Returns a
+    dictionary of cutoff:{taxa group:count}. interned is as for classify_hits.
+    """
+    if interned is None:
+        interned = intern_species(subjects, definitions, taxconv)
+    species, hit_species, groups, group_lookup = interned
+    order = np.argsort(scores, kind='mergesort')
+    sorted_scores = scores[order]
+    sorted_groups = group_lookup[hit_species[order]]
+
+    cutoffs = sorted(cutoffs)
+    bounds = list(np.searchsorted(sorted_scores, cutoffs, side='left')) + [len(scores)]
+    bins = np.array([ np.bincount(sorted_groups[bounds[k]:bounds[k + 1]],
+                                  minlength=len(groups)) for k in range(len(cutoffs)) ])
+    above = np.cumsum(bins[::-1], axis=0)[::-1]
+
+    sweep = {}
+    for k, cutoff in enumerate(cutoffs):
+        sweep[cutoff] = { g:int(n) for g, n in zip(groups, above[k]) }
+        sweep[cutoff]['unknown'] += int(bounds[k])
+    return sweep
+
+def add_counts(total, counts):
+    "adds the counts in dictionary counts (which may be nested) to those in total"
+    for k, n in counts.iteritems():
+        if isinstance(n, dict):
+            add_counts(total.setdefault(k, {}), n)
+        else:
+            total[k] = total.get(k, 0) + n
+
+def classify_blocks(hits, block_rows, classify):
+    """
+    classifies a stream of (gene, score, subject) best hits block_rows at a time. classify
+    is called with the scores and subjects of each block, and must return a tuple of
+    count dictionaries (as classify_hits does), which are summed over all blocks.
+    """
+    totals = None
+    hits = iter(hits)
+    while True:
+        block = list(islice(hits, block_rows))
+        if not block:
+            break
+        scores = np.array([ h[1] for h in block ], dtype=float)
+        subjects = np.array([ h[2] for h in block ], dtype=str)
+        del block
+        counts = classify(scores, subjects)
+        if totals is None:
+            totals = tuple( {} for c in counts )
+        for total, c in zip(totals, counts):
+            add_counts(total, c)
+    return totals
+
 def make_autopct(values):
     """
     This function is used by plt.pie to return only values greater than 1%, to reduce
@@ -434,20 +940,25 @@ def make_autopct(values):
             return "%.1f%%" % pct
     return my_autopct
 
+def collate_small(taxcount):
+    "returns a copy of taxcount with all classes of < 1% of the total added to 'others'"
+    total_trans = sum(taxcount.values())
+
+    # add new class to combine old results into:
+    newcount = { 'others':0 }
+    for t in taxcount:
+        if float(taxcount[t]) / max(1, total_trans) < 0.01:
+            newcount['others'] += taxcount[t]
+        else:
+            newcount[t] = taxcount[t]
+    return newcount
+
 def pie_chart(taxcount, filename="pie_chart.pdf", truncate=True):
 
     # collate all small classes (< 1%) together if truncate == True
     total_trans = sum(taxcount.values())
     if truncate:
-        orig_keys = taxcount.keys()[:]
-
-        # add new class to combine old results into:
-        newcount = { 'others':0 }
-        for t in orig_keys:
-            if float(taxcount[t]) / total_trans < 0.01:
-                newcount['others'] += taxcount[t]
-            else:
-                newcount[t] = taxcount[t]
+        newcount = collate_small(taxcount)
 
         # because of collation, we can print all % values
         autopct = "%.1f%%"
@@ -482,6 +993,42 @@ def pie_chart(taxcount, filename="pie_chart.pdf", truncate=True):
     plt.savefig(filename, format='pdf')
     plt.show()
 
+def sweep_table(sweep, filename):
+    "writes the taxa group counts at each cutoff as a tab-separated table"
+    cutoffs = sorted(sweep)
+    groups = sorted(set(chain(*sweep.values())))
+    handle = open(filename, 'w')
+    handle.write("\t".join(["taxa"] + [ "%g" % c for c in cutoffs ]) + "\n")
+    for g in groups:
+        handle.write("\t".join([g] + [ str(sweep[c].get(g, 0)) for c in cutoffs ]) + "\n")
+    handle.close()
+
+def sweep_chart(sweep, filename="sweep_chart.pdf"):
+    "draws a pie chart of the taxa distribution at each cutoff, side by side"
+    cutoffs = sorted(sweep)
+    cols = min(3, len(cutoffs))
+    rows = int(np.ceil(len(cutoffs) / float(cols)))
+    plt.figure(figsize=(5 * cols, 5 * rows))
+    for k, cutoff in enumerate(cutoffs):
+        taxcount = sweep[cutoff]
+        total_trans = sum(taxcount.values())
+
+        newcount = collate_small(taxcount)
+
+        ax = plt.subplot(rows, cols, k + 1)
+        pie_wedge_collection = ax.pie(newcount.values(),
+                                      labels=newcount.keys(),
+                                      labeldistance=1.05,
+                                      autopct="%.1f%%")
+        for pie_wedge in pie_wedge_collection[0]:
+            pie_wedge.set_edgecolor('white')
+        ax.axis('equal')
+        ax.set_title("cutoff %g\n(%d transcripts)" % (cutoff, total_trans))
+
+    plt.tight_layout()
+    plt.savefig(filename, format='pdf')
+    plt.show()
+
 if __name__ == '__main__':
     dbpaths = config.import_paths()
 
@@ -494,8 +1041,6 @@ if __name__ == '__main__':
     temp_dir = tempfile.mkdtemp()
     os.rmdir(temp_dir)  # dir must be empty!
 
-    best_hit = {}
-
     """
     # populate with hymenopteran hits
     handle = open(hymen, 'rb')
@@ -507,52 +1052,52 @@ if __name__ == '__main__':
     """
 
 
-    # add all genes to the list, replacing existing entries if the score is higher.
-    for bf in args.blast_results:
-        handle = open(bf, 'rb')
-        for line in handle:
-            score = float(line.split()[2])
-            gene = line.split()[0]
-            species = line.split()[1]
-            if gene in best_hit:
-                if score > best_hit[gene][0]:
-                    best_hit[gene] = (score, species)
-            else:
-                best_hit[gene] = (score, species)
+    # load swissprot species descriptors
+    definitions = SpeciesDefinitions(args.swissprot_definitions)
 
+    # cluster by species, and species by taxonomic level (each being monophyletic with
+    # ponerine ants)
+    taxconv = get_taxa_groups()
 
-    # create dictionary of swissprot species descriptors
-    definitions = {}
-    handle = open(args.swissprot_definitions, 'rb')
+    if args.cutoffs:
+        cutoffs = [ float(c) for c in args.cutoffs.split(',') ]
+    else:
+        cutoffs = []
 
-    for line in handle:
-        if line.strip() !=  "" and line[0] != " ":
-            definitions[line.split()[0]] = line.strip()
-            prior = line.split()[0]
+    def classify(scores, subjects):
+        interned = intern_species(subjects, definitions, taxconv)
+        results, taxcount = classify_hits(scores, subjects, definitions, taxconv,
+                                          interned=interned)
+        if cutoffs:
+            sweep = sweep_cutoffs(scores, subjects, definitions, taxconv, cutoffs,
+                                  interned=interned)
         else:
-            definitions[prior] += line.strip()
-
-    handle.close()
-
-    # cluster by species
-    results = {"unknown":0}
+            sweep = {}
+        return results, taxcount, sweep
 
-    for g in best_hit:
-        if best_hit[g][0] < 70:
-            results["unknown"] += 1
+    # find the best hit of every gene in each file (in parallel), then combine them,
+    # replacing existing entries if the score is higher.
+    if args.memory_budget:
+        # divide the budget between the files being read at once:
+        max_rows = max(1, args.memory_budget * 2**20 // ROW_BYTES // max(1, args.threads))
+        run_dir = tempfile.mkdtemp(prefix='best_hits.', dir=args.cache_dir)
+        try:
+            parse = partial(best_hit_runs, run_dir=run_dir, max_rows=max_rows)
+            runs = list(chain(*parse_files(parse, args.blast_results, args.threads)))
+            hits = merge_best_hit_runs(runs, run_dir)
+            results, taxcount, sweep = classify_blocks(hits,
+                                                       max_rows * max(1, args.threads),
+                                                       classify) or ({}, {}, {})
+        finally:
+            shutil.rmtree(run_dir)
+    else:
+        if args.no_cache:
+            parse = best_hits
         else:
-            metaz = best_hit[g][1].split('_')[-1]
-            if metaz in definitions:
-                if metaz in results:
-                    results[metaz] += 1
-                else:
-                    results[metaz] = 1
-            else:
-                hymen = best_hit[g][1].split('|')[0]
-                if hymen in results:
-                    results[hymen] += 1
-                else:
-                    results[hymen] = 1
+            parse = partial(cached_best_hits, cache_dir=args.cache_dir)
+        genes, scores, subjects = merge_best_hits(parse_files(parse, args.blast_results,
+                                                              args.threads))
+        results, taxcount, sweep = classify(scores, subjects)
 
     for sp in results:
         if sp in definitions:
@@ -562,20 +1107,30 @@ if __name__ == '__main__':
 
     print '#' * 45
 
-    # cluster species by taxonomic level (each being monophyletic with ponerine ants)
-    taxconv = get_taxa_groups()
+    for t in taxcount:
+        print "%-20s %d" % (t, taxcount[t])
 
-    taxcount = { t:0 for t in taxconv.values() }
-    taxcount['unknown'] = 0
+    # count the hits at every level of the taxonomy
+    tree = TaxaTree(load_taxa_parents(args.taxa_groups))
+    levels = tree.rollup(results, taxconv)
 
-    for sp in results:
-        if sp in taxconv:
-            taxcount[taxconv[sp]] += results[sp]
-        else:
-            taxcount['unknown'] += results[sp]
+    print '#' * 45
 
-    for t in taxcount:
-        print "%-20s %d" % (t, taxcount[t])
+    handle = open(logfile[:-3] + 'levels.tsv', 'w')
+    handle.write("taxa\tparent\thits\n")
+    for node, depth in tree.walk():
+        if levels[node] == 0 and node not in TAXA_PARENTS:
+            continue
+        print "%-30s %d" % ("  " * depth + node, levels[node])
+        parent = tree.parent[tree.index[node]]
+        handle.write("%s\t%s\t%d\n" % (node, tree.nodes[parent] if parent != -1 else "",
+                                         levels[node]))
+    handle.close()
+
+    # tabulate and plot the taxa at every cutoff requested
+    if sweep:
+        sweep_table(sweep, logfile[:-3] + 'cutoffs.tsv')
+        sweep_chart(sweep, logfile[:-3] + 'cutoffs_chart.pdf')
 
     # plot all transcripts
     pie_chart(taxcount, logfile[:-3] + 'chart.pdf')
@@ -1,60 +1,1081 @@
 #!/usr/bin/env python
 
-import re
 import os
+import glob
 import sys
+import gzip
 import math
+import mmap
+import zlib
+import struct
+import string
+import array
+import json
+import heapq
+import hashlib
+import time
+import shutil
+import sqlite3
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from functools import partial
+from itertools import chain, groupby
 
 import argparse
+import numpy as np
 
-def count_deflines(fastafile):
-    "counts number of sequences are in a fasta file"
-    fasta_h = open(fastafile, 'rb')
+# default number of query batches per blast process with --wait. Processes that finish
+# their batch early take the next one, so slow batches do not hold up the end of the run:
+BATCHES_PER_PROCESS = 4
 
-    counter = 0
-    for line in fasta_h:
-        if re.search('^>', line) is not None:
-            counter += 1
+# the most hits blast reports for a query (its default -max_target_seqs):
+BLAST_MAX_TARGET_SEQS = 500
 
-    fasta_h.close()
+def count_deflines(fastafile):
+    "counts number of sequences are in a fasta file (which may be gzipped)"
+    fasta_mm = open_fasta(fastafile)
+    counter = 0
+    pos = 0 if fasta_mm[:1] == '>' else fasta_mm.find('\n>')
+    while pos != -1:
+        counter += 1
+        pos = fasta_mm.find('\n>', pos + 1)
+    fasta_mm.close()
     return counter
 
-def split_fasta(fastafile, numfiles):
-    "splits fastafile into numfiles even sized fastafiles"
+def fasta_prefix(fastafile):
+    "returns the fasta file name without its extension (or extensions, if gzipped)"
+    if fastafile.endswith('.gz'):
+        fastafile = fastafile[:-3]
+    return os.path.splitext(fastafile)[0]
 
-    numseqs = count_deflines(fastafile)
-    seqlimit = math.ceil( 1. * numseqs / numfiles ) # num seqs per split file
+def bgzf_blocks(gz_mm):
+    """
+    returns the (offset, compressed size, uncompressed size) of every block of a
+    memory-mapped bgzip file, or None if it is not bgzip compressed. Only the block
+    headers and footers are read.
+    """
+    blocks = []
+    pos = 0
+    while pos < len(gz_mm):
+        header = gz_mm[pos:pos + 12]
+        if len(header) < 12 or header[:4] != '\x1f\x8b\x08\x04':
+            return None
+        xlen = struct.unpack('<H', header[10:12])[0]
+        extra = gz_mm[pos + 12:pos + 12 + xlen]
+        bsize = None
+        while len(extra) >= 4:
+            slen = struct.unpack('<H', extra[2:4])[0]
+            if extra[:2] == 'BC' and slen == 2:
+                bsize = struct.unpack('<H', extra[4:6])[0] + 1
+            extra = extra[4 + slen:]
+        if bsize is None:
+            return None
+        isize = struct.unpack('<I', gz_mm[pos + bsize - 4:pos + bsize])[0]
+        blocks.append((pos, bsize, isize))
+        pos += bsize
+    return blocks
 
+def inflate(data):
+    "decompresses a string of concatenated gzip members"
+    text = []
+    while data:
+        inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        text.append(inflater.decompress(data))
+        data = inflater.unused_data
+    return ''.join(text)
+
+class EmptyFasta(object):
+    "stands in for the memory map of an empty fasta file, which mmap cannot map"
+    def __len__(self):
+        return 0
+    def __getitem__(self, index):
+        return ''[index]
+    def find(self, sub, *args):
+        return ''.find(sub, *args)
+    def seek(self, pos, whence=0):
+        pass
+    def tell(self):
+        return 0
+    def readline(self):
+        return ''
+    def close(self):
+        pass
+
+def open_fasta(fastafile, threads=1):
+    """
+    memory-maps fastafile for reading. Gzipped files are first decompressed to an
+    anonymous temporary file, which is mapped instead. The blocks of bgzip files are
+    decompressed in parallel by threads processes. An empty file (or gzip of an empty
+    file) returns an EmptyFasta.
+    """
     fasta_h = open(fastafile, 'rb')
+    if os.fstat(fasta_h.fileno()).st_size == 0:
+        fasta_h.close()
+        return EmptyFasta()
+    fasta_mm = mmap.mmap(fasta_h.fileno(), 0, access=mmap.ACCESS_READ)
+    fasta_h.close()
+    if fasta_mm[:2] != '\x1f\x8b':
+        return fasta_mm
+
+    gz_mm = fasta_mm
+    text_h = tempfile.TemporaryFile()
+    blocks = bgzf_blocks(gz_mm)
+    if blocks is None:
+        raw_h = open(fastafile, 'rb')
+        gz_h = gzip.GzipFile(fileobj=raw_h)
+        shutil.copyfileobj(gz_h, text_h)
+        gz_h.close()
+        raw_h.close()
+    else:
+        # decompress groups of blocks of about 4 Mb in each process:
+        bounds = [0]
+        for offset, bsize, isize in blocks:
+            if offset - bounds[-1] > 1 << 22:
+                bounds.append(offset)
+        bounds.append(len(gz_mm))
+        compressed = ( gz_mm[bounds[i]:bounds[i + 1]] for i in range(len(bounds) - 1) )
+        if threads > 1:
+            pool = multiprocessing.Pool(threads)
+            for text in pool.imap(inflate, compressed):
+                text_h.write(text)
+            pool.close()
+            pool.join()
+        else:
+            for text in compressed:
+                text_h.write(inflate(text))
+    gz_mm.close()
+
+    text_h.flush()
+    if os.fstat(text_h.fileno()).st_size == 0:
+        text_h.close()
+        return EmptyFasta()
+    fasta_mm = mmap.mmap(text_h.fileno(), 0, access=mmap.ACCESS_READ)
+    text_h.close()
+    return fasta_mm
 
-    line = ''
+def iter_records(fasta_mm):
+    """
+    yields (query id, start, end, sequence lines) for each record in a memory-mapped
+    fasta file, where start and end are the byte offsets of the whole record.
+    """
+    fasta_mm.seek(0)
+    name = None
+    start = 0
+    seq = []
+    while True:
+        pos = fasta_mm.tell()
+        line = fasta_mm.readline()
+        if not line or line[0] == '>':
+            if name is not None:
+                yield name, start, pos, seq
+            if not line:
+                break
+            name = line[1:].split()[0]
+            start = pos
+            seq = []
+        elif name is not None:
+            seq.append(line.strip())
+
+def index_fasta(fasta_mm, dedup=False):
+    """
+    builds an index of the records in a memory-mapped fasta file in a single pass.
+
+    Returns a list of (query id, start, end, residues, sequence md5) for each record to
+    be searched, a dictionary of query name:position in the file, for ordering the results, and a
+    dictionary of searched query name:[names of identical queries]. If dedup is True,
+    only the first of any identical sequences (ignoring case) is listed for searching,
+    and the others are recorded as its duplicates so their hits can be copied from it
+    when the results are merged.
+    """
+    records = []
+    order = {}
+    seen = {}       # sequence md5:first query with that sequence
+    duplicates = {}
+    for name, start, end, seq in iter_records(fasta_mm):
+        order[name] = len(order)
+        digest = hashlib.md5(''.join(seq).upper()).hexdigest()
+        if dedup:
+            if digest in seen:
+                duplicates.setdefault(seen[digest], []).append(name)
+                continue
+            seen[digest] = name
+        records.append((name, start, end, sum( len(line) for line in seq ), digest))
+    return records, order, duplicates
+
+def chunk_records(records, numchunks, balance='sequences'):
+    """
+    divides indexed records into at most numchunks chunks. If balance is 'sequences',
+    each chunk gets the same number of consecutive sequences. If balance is 'residues',
+    sequences are taken longest first and each is added to whichever chunk currently
+    holds the fewest residues, so that chunks take a similar time to blast. Records are
+    kept in input order within each chunk, and empty chunks are dropped.
+    """
+    if balance == 'residues':
+        chunks = [ [] for f in range(numchunks) ]
+        loads = [ (0, f) for f in range(numchunks) ] # (residues, chunk) heap
+        for record in sorted(records, key=lambda r: -r[3]):
+            residues, f = heapq.heappop(loads)
+            chunks[f].append(record)
+            heapq.heappush(loads, (residues + record[3], f))
+        for chunk in chunks:
+            chunk.sort(key=lambda r: r[1])
+    else:
+        seqlimit = max(1, int(math.ceil( 1. * len(records) / numchunks ))) # seqs per chunk
+        chunks = [ records[i:i + seqlimit] for i in range(0, len(records), seqlimit) ]
+    return [ chunk for chunk in chunks if chunk ]
+
+def record_ranges(chunk):
+    "returns the (start, end) byte ranges of a chunk's records, joining adjacent records"
+    ranges = []
+    for name, start, end, residues, digest in chunk:
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+def feed_ranges(pipe, fasta_mm, ranges):
+    """
+    writes the byte ranges of a memory-mapped fasta file to pipe without copying them,
+    then closes it.
+    """
+    try:
+        for start, end in ranges:
+            pipe.write(buffer(fasta_mm, start, end - start))
+        pipe.close()
+    except IOError:
+        pass # the process has exited, and its exit code will report why
+
+def ranges_md5(fasta_mm, ranges):
+    "returns the md5 hex digest of the byte ranges of a memory-mapped file"
+    md5 = hashlib.md5()
+    for start, end in ranges:
+        md5.update(buffer(fasta_mm, start, end - start))
+    return md5.hexdigest()
+
+def split_fasta(fastafile, numfiles, balance='sequences', threads=1):
+    """
+    splits fastafile (which may be gzipped, see open_fasta) into numfiles fastafiles,
+    balanced by number of sequences or by number of residues (see chunk_records).
+    """
+    fasta_mm = open_fasta(fastafile, threads)
+    records, order, duplicates = index_fasta(fasta_mm)
+    chunks = chunk_records(records, numfiles, balance)
     for f in range(numfiles):
-        filepref = os.path.splitext(fastafile)[0]
-        fasta_f = open('.'.join([filepref,str(f),'fasta']), 'w')
-        counter = 0
-        fasta_f.write(line)
-        for line in fasta_h:
-            if re.search('^>', line) is not None:
-                counter += 1
-                if counter == seqlimit:
-                    break
-            fasta_f.write(line)
-        fasta_f.close()
-    fasta_h.close
+        chunk_h = open(chunk_files(fastafile, f)[0], 'wb')
+        if f < len(chunks):
+            for start, end in record_ranges(chunks[f]):
+                chunk_h.write(buffer(fasta_mm, start, end - start))
+        chunk_h.close()
+    fasta_mm.close()
 
 def blastall(fastafile, numfiles, database, blastype='blastp'):
     "does blast of split fastafiles against database"
     for f in range(numfiles):
-        filepref = os.path.splitext(fastafile)[0]
+        filepref = fasta_prefix(fastafile)
         fasta_f = '.'.join([filepref,str(f),'fasta'])
         cmd =   blastype + ' -db ' + database + \
                 ' -query ' + fasta_f + \
                 ' -outfmt 6 -out ' + filepref + '.' + str(f) + '.blastp.tsv &'
         os.system(cmd)
-        # better tracking of this could be achieved using os.fork(), dropping the & and
-        # then recombining the files, but this is beyond my current abilities
+        # for tracked runs that wait for each chunk and recombine the output files,
+        # use blast_pool() instead.
+
+def chunk_files(fastafile, f):
+    "returns the split fasta file and blast output file names for chunk f"
+    filepref = fasta_prefix(fastafile)
+    return ( '.'.join([filepref,str(f),'fasta']),
+             '.'.join([filepref,str(f),'blastp.tsv']) )
+
+def blast_command(fasta_f, database, out_f, blastype='blastp', dbsize=None, threads=1):
+    """
+    returns the argument list for a single blast search (fasta_f '-' reads from stdin).
+    If dbsize is given, e-values are calculated for a database of that many letters.
+    """
+    cmd = [blastype, '-db', database, '-query', fasta_f, '-outfmt', '6', '-out', out_f]
+    if dbsize:
+        cmd += ['-dbsize', str(dbsize)]
+    if threads > 1:
+        cmd += ['-num_threads', str(threads)]
+    return cmd
+
+def dump_database(database, db_fasta):
+    "writes every sequence of a blast database to db_fasta, using blastdbcmd"
+    subprocess.check_call(['blastdbcmd', '-db', database, '-entry', 'all',
+                           '-out', db_fasta])
+
+def record_sequence(fasta_mm, record):
+    "returns the sequence of an indexed record, without its defline or line breaks"
+    text = fasta_mm[record[1]:record[2]]
+    return ''.join(text[text.find('\n') + 1:].split())
+
+def sequence_blocks(records, size=1 << 24):
+    "yields lists of consecutive indexed records with about size residues between them"
+    block = []
+    residues = 0
+    for record in records:
+        block.append(record)
+        residues += record[3]
+        if residues >= size:
+            yield block
+            block = []
+            residues = 0
+    if block:
+        yield block
+
+def kmer_hashes(seqs, k, bits):
+    """
+    finds every k-mer of letters (of up to 13 letters) in seqs, a string of sequences
+    joined by '*'. Returns the position of each k-mer in seqs, and its hash as an
+    integer of bits bits.
+    """
+    letters = np.zeros(256, dtype=np.uint64)
+    letters[np.frombuffer(string.ascii_uppercase, dtype=np.uint8)] = np.arange(1, 27)
+    codes = letters[np.frombuffer(seqs.upper(), dtype=np.uint8)]
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint64)
+    kmers = np.zeros(n, dtype=np.uint64)
+    valid = np.ones(n, dtype=bool)
+    for i in range(k):
+        kmers = kmers * np.uint64(27) + codes[i:i + n]
+        valid &= codes[i:i + n] > 0
+    hashes = (kmers[valid] * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(64 - bits)
+    return np.flatnonzero(valid), hashes
+
+def kmer_table(database, k=5, bits=26):
+    """
+    builds a hashed table of the k-mers in a blast database: a boolean array of 2**bits
+    entries that is True wherever the hash of a database k-mer falls. A k-mer not found
+    in the table is certainly not in the database.
+    """
+    table = np.zeros(1 << bits, dtype=bool)
+    temp_dir = tempfile.mkdtemp()
+    db_fasta = os.path.join(temp_dir, 'db.fasta')
+    dump_database(database, db_fasta)
+    db_mm = open_fasta(db_fasta)
+    records, order, duplicates = index_fasta(db_mm)
+    for block in sequence_blocks(records):
+        seqs = '*'.join( record_sequence(db_mm, r) for r in block )
+        table[kmer_hashes(seqs, k, bits)[1]] = True
+    db_mm.close()
+    shutil.rmtree(temp_dir)
+    return table
+
+def prefilter_records(fasta_mm, records, table, k=5):
+    """
+    splits indexed query records into those sharing at least one k-mer with the
+    database (see kmer_table), and those that share none. Blast seeds its alignments
+    on short word matches, so queries that share no k-mer with the database are
+    unlikely to have hits, but blast can also seed on similar (not identical) words,
+    so this is a heuristic rather than an exact filter. Returns both lists.
+    """
+    bits = int(math.log(len(table), 2))
+    keep = []
+    skipped = []
+    for block in sequence_blocks(records):
+        seqs = [ record_sequence(fasta_mm, r) for r in block ]
+        starts = np.cumsum([0] + [ len(seq) + 1 for seq in seqs[:-1] ])
+        positions, hashes = kmer_hashes('*'.join(seqs), k, bits)
+        found = positions[table[hashes]]
+        shared = np.bincount(np.searchsorted(starts, found, side='right') - 1,
+                             minlength=len(block)) > 0
+        for record, hit in zip(block, shared):
+            if hit:
+                keep.append(record)
+            else:
+                skipped.append(record)
+    return keep, skipped
+
+def calibrate_layout(fasta_mm, records, database, cores, blastype='blastp', dbsize=None,
+                     sample=200):
+    """
+    finds the split of cores into blast processes x threads per process that searches
+    fastest on this machine. A sample of about sample records, spread through the input,
+    is searched once with every layout that uses all the cores (every number of threads
+    that divides cores), and the residues searched per second are timed. One record is
+    searched first, untimed, so that the first layout timed does not also pay for
+    reading the database from disk.
+
+    Returns the best (processes, threads) and a dictionary of (processes,
+    threads):residues per second for every layout tried.
+    """
+    subset = records[::max(1, len(records) // sample)]
+    residues = sum( r[3] for r in subset )
+    temp_dir = tempfile.mkdtemp()
+
+    # warm the database cache:
+    out_f = os.path.join(temp_dir, 'warmup.blastp.tsv')
+    run_pool([(0, blast_command('-', database, out_f, blastype, dbsize, cores),
+               partial(feed_ranges, fasta_mm=fasta_mm, ranges=record_ranges(subset[:1])))],
+             1, poll=0.05)
+
+    speeds = {}
+    for threads in [ t for t in range(1, cores + 1) if cores % t == 0 ]:
+        procs = cores // threads
+        jobs = []
+        for c, chunk in enumerate(chunk_records(subset, procs, balance='residues')):
+            out_f = os.path.join(temp_dir, '%d.%d.blastp.tsv' % (threads, c))
+            jobs.append((c, blast_command('-', database, out_f, blastype, dbsize, threads),
+                         partial(feed_ranges, fasta_mm=fasta_mm,
+                                 ranges=record_ranges(chunk))))
+        begin = time.time()
+        results = run_pool(jobs, procs, poll=0.05)
+        seconds = time.time() - begin
+        if all( r[0] == 0 for r in results.values() ):
+            speeds[(procs, threads)] = residues / max(seconds, 1e-6)
+    shutil.rmtree(temp_dir)
+    if not speeds:
+        return (cores, 1), speeds
+    return max(speeds, key=speeds.get), speeds
+
+def shard_database(database, numshards, blastype='blastp'):
+    """
+    splits a blast database into numshards databases (<database>.shard##) with similar
+    numbers of letters, using blastdbcmd and makeblastdb. The shards are reused by later
+    runs until the database changes.
+
+    Returns the shard database names and the total number of letters in the database.
+    Passing this to blast as -dbsize makes the e-values of a search against each shard
+    the same as those of a search against the whole database.
+    """
+    shards = [ "%s.shard%02d" % (database, s) for s in range(numshards) ]
+    shard_log = database + '.shards.json'
+    fingerprint = database_fingerprint(database)
+    if os.path.exists(shard_log):
+        log_h = open(shard_log, 'rb')
+        log = json.load(log_h)
+        log_h.close()
+        if log['fingerprint'] == fingerprint and log['shards'] == shards:
+            return shards, log['dbsize']
+
+    dbtype = 'nucl' if blastype in ('blastn', 'tblastn', 'tblastx') else 'prot'
+    temp_dir = tempfile.mkdtemp()
+    db_fasta = os.path.join(temp_dir, 'db.fasta')
+    dump_database(database, db_fasta)
+    db_mm = open_fasta(db_fasta)
+    records, order, duplicates = index_fasta(db_mm)
+    dbsize = sum( r[3] for r in records )
+    for s, chunk in enumerate(chunk_records(records, numshards, balance='residues')):
+        shard_fasta = os.path.join(temp_dir, 'shard.fasta')
+        shard_h = open(shard_fasta, 'wb')
+        for start, end in record_ranges(chunk):
+            shard_h.write(buffer(db_mm, start, end - start))
+        shard_h.close()
+        subprocess.check_call(['makeblastdb', '-in', shard_fasta, '-dbtype', dbtype,
+                               '-parse_seqids', '-out', shards[s]])
+    db_mm.close()
+    shutil.rmtree(temp_dir)
+
+    log_h = open(shard_log, 'wb')
+    json.dump({'fingerprint':fingerprint, 'shards':shards, 'dbsize':dbsize}, log_h)
+    log_h.close()
+    return shards, dbsize
+
+def run_pool(jobs, numprocs, poll=0.5, on_finish=None, on_start=None):
+    """
+    runs each (name, command, feed) job as a subprocess, keeping at most numprocs
+    running at any one time. If feed is not None, it is run in its own thread and
+    passed the subprocess's stdin pipe to write to. Blocks until all jobs have finished,
+    and returns a dictionary of name:(exit code, stderr) for every job. If given,
+    on_start is called with the name of each job as it starts, and on_finish is called
+    with (name, exit code, stderr) as soon as each job ends.
+    """
+    pending = list(jobs)
+    running = {}
+    results = {}
+    while pending or running:
+        while pending and len(running) < numprocs:
+            name, cmd, feed = pending.pop(0)
+            err_h = tempfile.TemporaryFile()
+            if on_start:
+                on_start(name)
+            try:
+                if feed is None:
+                    proc = subprocess.Popen(cmd, stderr=err_h, close_fds=True)
+                else:
+                    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=err_h,
+                                            close_fds=True)
+                    feeder = threading.Thread(target=feed, args=(proc.stdin,))
+                    feeder.daemon = True
+                    feeder.start()
+                running[name] = (proc, err_h)
+            except OSError as e:
+                err_h.close()
+                results[name] = (127, "could not start %s: %s" % (cmd[0], e))
+                if on_finish:
+                    on_finish(name, *results[name])
+
+        for name in running.keys():
+            proc, err_h = running[name]
+            if proc.poll() is not None:
+                err_h.seek(0)
+                results[name] = (proc.returncode, err_h.read())
+                err_h.close()
+                del running[name]
+                if on_finish:
+                    on_finish(name, *results[name])
+
+        if running:
+            time.sleep(poll)
+
+    return results
+
+def estimate_makespan(costs, numprocs):
+    """
+    returns the time at which the last job finishes if jobs of these costs are started
+    in the given order, each as soon as one of numprocs processes is free
+    """
+    finish = [0] * numprocs
+    for cost in costs:
+        heapq.heappush(finish, heapq.heappop(finish) + cost)
+    return max(finish)
+
+def schedule_jobs(jobs, costs, numprocs, schedule='longest'):
+    """
+    orders pool jobs for running. If schedule is 'longest', the jobs with the highest
+    estimated cost (a dictionary of job name:cost) are started first, which stops the
+    largest jobs from being left until the end of the run. Otherwise the jobs keep their
+    input order. Returns the ordered jobs, and a log of the order and its estimated
+    makespan compared with that of the input order.
+    """
+    if schedule == 'longest':
+        ordered = sorted(jobs, key=lambda job: costs[job[0]], reverse=True)
+    else:
+        ordered = list(jobs)
+    log = {'schedule':schedule,
+           'order':[ [job[0], costs[job[0]]] for job in ordered ],
+           'estimated_makespan':estimate_makespan(
+                                    [ costs[job[0]] for job in ordered ], numprocs),
+           'input_order_makespan':estimate_makespan(
+                                    [ costs[job[0]] for job in jobs ], numprocs)}
+    return ordered, log
+
+class ProgressMonitor(object):
+    """
+    follows the output files of running blast searches to count the queries each has
+    finished, and every interval seconds reports the queries per second of each search,
+    the ETA of the whole run and any searches that are falling behind. Queries without
+    hits write no output, so they are only counted once their search has finished.
+    """
+    def __init__(self, searches, interval=60):
+        "searches is a dictionary of name:(output file, number of queries, residues)"
+        self.searches = {}
+        for name, (out_f, queries, residues) in searches.items():
+            self.searches[name] = {'output':out_f, 'queries':queries, 'residues':residues,
+                                   'done':0, 'start':None, 'end':None, 'exit_code':None,
+                                   'offset':0, 'last_query':None}
+        self.interval = interval
+        self.begin = time.time()
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
 
+    def started(self, name):
+        with self.lock:
+            self.searches[name]['start'] = time.time()
 
+    def finished(self, name, returncode):
+        with self.lock:
+            search = self.searches[name]
+            search.update(end=time.time(), exit_code=returncode)
+            if returncode == 0:
+                search['done'] = search['queries']
+
+    def tail(self, search):
+        "counts the queries in the new complete lines of a running search's output"
+        if not os.path.exists(search['output']):
+            return
+        out_h = open(search['output'], 'rb')
+        out_h.seek(search['offset'])
+        text = out_h.read()
+        out_h.close()
+        text = text[:text.rfind('\n') + 1]
+        search['offset'] += len(text)
+        for line in text.splitlines():
+            query = line.split('\t', 1)[0]
+            if query != search['last_query']:
+                if search['last_query'] is not None:
+                    search['done'] += 1 # the previous query has no more hits to come
+                search['last_query'] = query
+
+    def report(self):
+        "prints the progress of each running search, the run's ETA and any stragglers"
+        now = time.time()
+        with self.lock:
+            running = [ (n, s) for n, s in self.searches.items()
+                        if s['start'] is not None and s['end'] is None ]
+            for name, search in running:
+                self.tail(search)
+            total = sum( s['queries'] for s in self.searches.values() )
+            done = sum( s['done'] for s in self.searches.values() )
+
+        rate = done / (now - self.begin)
+        if rate > 0:
+            eta = "%.0f s" % ((total - done) / rate)
+        else:
+            eta = "unknown"
+        print "%d of %d queries searched (%.2f queries/s). ETA: %s" % (done, total, rate, eta)
+
+        remaining = {}
+        for name, search in sorted(running):
+            qps = search['done'] / (now - search['start'])
+            print "  search %s: %d of %d queries (%.2f queries/s)" % (name, search['done'],
+                                                search['queries'], qps)
+            if qps > 0:
+                remaining[name] = (search['queries'] - search['done']) / qps
+            else:
+                remaining[name] = float('inf')
+        if len(remaining) > 1:
+            median = sorted(remaining.values())[len(remaining) // 2]
+            stragglers = [ n for n in sorted(remaining) if remaining[n] > 2 * median ]
+            if stragglers:
+                print "  stragglers: %s" % (", ".join( str(n) for n in stragglers ))
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def summary(self, summary_f, settings=None, schedule=None):
+        "writes the timing of each search, and of the whole run, to summary_f as json"
+        searches = {}
+        for name, search in self.searches.items():
+            timing = { k:search[k] for k in ('output', 'queries', 'residues', 'exit_code') }
+            if search['start'] is not None and search['end'] is not None:
+                timing['seconds'] = search['end'] - search['start']
+                if timing['seconds'] > 0:
+                    timing['queries_per_second'] = search['queries'] / timing['seconds']
+            searches[name] = timing
+        summary_h = open(summary_f, 'wb')
+        json.dump({'settings':settings, 'seconds':time.time() - self.begin,
+                   'searches':searches, 'schedule':schedule},
+                  summary_h, indent=1, sort_keys=True)
+        summary_h.close()
+
+def keyed_lines(out_h, order, i, duplicates=None):
+    """
+    yields (query position, i, row number, line) for each line of a blast output file,
+    in query position order. The rows of a query with duplicates are repeated with each
+    duplicate's name, at that duplicate's position.
+    """
+    if duplicates is None:
+        duplicates = {}
+    pending = [] # heap of duplicate rows whose position has not been reached
+    for n, line in enumerate(out_h):
+        query, hit = line.split('\t', 1)
+        pos = order[query]
+        while pending and pending[0][0] < pos:
+            yield heapq.heappop(pending)
+        yield pos, i, n, line
+        for dup in duplicates.get(query, []):
+            heapq.heappush(pending, (order[dup], i, n, dup + '\t' + hit))
+    while pending:
+        yield heapq.heappop(pending)
+
+def database_fingerprint(database):
+    """
+    returns an md5 hex digest of the names, sizes and modification times of the files of
+    a blast database, which changes whenever the database is rebuilt
+    """
+    md5 = hashlib.md5()
+    for db_f in sorted(glob.glob(database + '.*')):
+        if db_f.startswith(database + '.shard'):
+            continue # shards made by shard_database are not part of the database
+        stat = os.stat(db_f)
+        md5.update("%s %d %d\n" % (os.path.basename(db_f), stat.st_size, stat.st_mtime))
+    return md5.hexdigest()
+
+def open_cache(cache_f, database, cmd):
+    """
+    opens (creating if needed) a sqlite cache of blast hits, and returns the connection
+    and the key prefix for results of cmd against the current version of database.
+    Hits are stored under this prefix plus the md5 of the query sequence, so a query is
+    only answered from the cache if the same sequence has been searched with the same
+    blast program and options against an identical database.
+    """
+    cache_db = sqlite3.connect(cache_f)
+    cache_db.execute("CREATE TABLE IF NOT EXISTS hits (key TEXT PRIMARY KEY, rows TEXT)")
+    namespace = hashlib.md5(json.dumps([database_fingerprint(database)] + cmd))
+    return cache_db, namespace.hexdigest() + ':'
+
+def cached_rows(cache_db, key):
+    "returns the cached hit rows (without query id) for key, or None if not cached"
+    row = cache_db.execute("SELECT rows FROM hits WHERE key = ?", (key,)).fetchone()
+    if row is None:
+        return None
+    return str(row[0])
+
+def split_cached(cache_db, namespace, chunks):
+    """
+    removes the records already in the cache from each chunk. Returns the chunks left
+    to search (dropping any that are now empty) and the cached records in input order.
+    """
+    tosearch = []
+    cached = []
+    for chunk in chunks:
+        incache = [ cached_rows(cache_db, namespace + r[4]) is not None for r in chunk ]
+        cached += [ r for r, c in zip(chunk, incache) if c ]
+        chunk = [ r for r, c in zip(chunk, incache) if not c ]
+        if chunk:
+            tosearch.append(chunk)
+    cached.sort(key=lambda r: r[1])
+    return tosearch, cached
+
+def store_hits(cache_db, namespace, chunk, out_f):
+    """
+    saves the hits of every query in a searched chunk to the cache, including queries
+    with no hits. out_f must list the queries in the same order as the chunk.
+    """
+    out_h = open(out_f, 'rb')
+    groups = groupby(out_h, lambda line: line.split('\t', 1)[0])
+    query, lines = next(groups, (None, None))
+    for name, start, end, residues, digest in chunk:
+        if name == query:
+            hits = ''.join( line.split('\t', 1)[1] for line in lines )
+            query, lines = next(groups, (None, None))
+        else:
+            hits = ''
+        cache_db.execute("INSERT OR REPLACE INTO hits VALUES (?, ?)",
+                         (namespace + digest, hits))
+    cache_db.commit()
+    out_h.close()
+
+def write_cached(cache_db, namespace, records, cached_f):
+    "writes the cached hits of each record (in input order) as outfmt 6 rows to cached_f"
+    cached_h = open(cached_f, 'wb')
+    for name, start, end, residues, digest in records:
+        for hit in cached_rows(cache_db, namespace + digest).splitlines(True):
+            cached_h.write(name + '\t' + hit)
+    cached_h.close()
+
+def hit_rank(line, rank_by='bitscore'):
+    """
+    returns a sort key for an outfmt 6 row, lowest for the best hit: highest bitscore,
+    or lowest e-value (then highest bitscore) if rank_by is 'evalue'
+    """
+    cols = line.split('\t')
+    if rank_by == 'evalue':
+        return float(cols[10]), -float(cols[11])
+    return -float(cols[11])
+
+def top_hits(lines, numhits, rank_by='bitscore'):
+    """
+    yields the best numhits rows of each query from a stream of outfmt 6 rows that is
+    grouped by query, best first. At most numhits rows are held in memory at once. If
+    numhits is None, all rows of each query are yielded, best first.
+    """
+    rank = lambda line: hit_rank(line, rank_by)
+    for query, rows in groupby(lines, lambda line: line.split('\t', 1)[0]):
+        if numhits is None:
+            best = sorted(rows, key=rank)
+        else:
+            best = heapq.nsmallest(numhits, rows, key=rank)
+        for line in best:
+            yield line
+
+def merge_results(outfiles, merged_f, order=None, duplicates=None, numhits=None,
+                  rank_by='bitscore', rerank=False):
+    """
+    merges the blast output files into merged_f. If order (query name:position) is
+    given, this is a streaming k-way merge so that queries appear in that order,
+    otherwise the files are concatenated in the order given. Each output file must
+    already list its queries in increasing order, which blast does as long as each chunk
+    is in input order. If duplicates (query name:[identical query names]) is given, the
+    hits of each searched query are also written for each of its duplicates. This
+    requires order. If numhits is given, only the best numhits rows of each query are
+    kept (see top_hits). If rerank is True, the rows of each query are sorted best first,
+    which is needed when a query's hits come from more than one file (such as database
+    shards). Reranked queries are then also cut to BLAST_MAX_TARGET_SEQS rows if numhits
+    is not given, as a single search of the whole database would be. Memory use does not
+    depend on the size of the files.
+    """
+    if rerank and numhits is None:
+        numhits = BLAST_MAX_TARGET_SEQS
+    merged_h = open(merged_f, 'wb')
+    handles = [ open(out_f, 'rb') for out_f in outfiles ]
+    if order is None and numhits is None and not rerank:
+        for out_h in handles:
+            shutil.copyfileobj(out_h, merged_h)
+    else:
+        if order is None:
+            lines = chain(*handles)
+        else:
+            streams = [ keyed_lines(out_h, order, i, duplicates)
+                        for i, out_h in enumerate(handles) ]
+            lines = ( line for pos, i, n, line in heapq.merge(*streams) )
+        if numhits is not None or rerank:
+            lines = top_hits(lines, numhits, rank_by)
+        merged_h.writelines(lines)
+    for out_h in handles:
+        out_h.close()
+    merged_h.close()
+
+def reciprocal_best_hits(blast_f, rbh_f):
+    """
+    finds the reciprocal best hits in an all v all blast output file, reading it as a
+    stream. Only the best hit (by bitscore) of each query is kept, in arrays indexed by
+    sequence number, so memory depends on the number of sequences and not on the number
+    of hits. Self hits are ignored. Writes each pair, with the bitscore of each hit, to
+    rbh_f and returns the number of pairs found.
+    """
+    ids = {}        # sequence name:number
+    names = []
+    best = array.array('i')     # best hit of each sequence, or -1
+    score = array.array('d')    # bitscore of that hit
+    blast_h = open(blast_f, 'rb')
+    for line in blast_h:
+        cols = line.split('\t')
+        if cols[0] == cols[1]:
+            continue
+        for name in cols[:2]:
+            if name not in ids:
+                ids[name] = len(names)
+                names.append(name)
+                best.append(-1)
+                score.append(float('-inf'))
+        q = ids[cols[0]]
+        bitscore = float(cols[11])
+        if bitscore > score[q]:
+            best[q] = ids[cols[1]]
+            score[q] = bitscore
+    blast_h.close()
+
+    pairs = 0
+    rbh_h = open(rbh_f, 'w')
+    for q, s in enumerate(best):
+        if s > q and best[s] == q:
+            rbh_h.write("%s\t%s\t%s\t%s\n" % (names[q], names[s], score[q], score[s]))
+            pairs += 1
+    rbh_h.close()
+    return pairs
+
+def file_md5(filename):
+    "returns the md5 hex digest of a file's contents"
+    md5 = hashlib.md5()
+    file_h = open(filename, 'rb')
+    for block in iter(lambda: file_h.read(1 << 20), ''):
+        md5.update(block)
+    file_h.close()
+    return md5.hexdigest()
+
+def load_manifest(manifest_f, settings):
+    """
+    returns the chunk records saved in manifest_f by an earlier run, or an empty
+    dictionary if there is no manifest or it was written with different settings.
+    """
+    if not os.path.exists(manifest_f):
+        return {}
+    manifest_h = open(manifest_f, 'rb')
+    try:
+        manifest = json.load(manifest_h)
+    except ValueError:
+        return {}
+    finally:
+        manifest_h.close()
+    if manifest.get('settings') != settings:
+        return {}
+    return { int(f):chunk for f,chunk in manifest['chunks'].items() }
+
+def tuned_layout(manifest_f, cores):
+    """
+    returns the (processes, threads) layout chosen by --autotune for cores cores in the
+    run recorded in manifest_f, or None if that run was not tuned for as many cores.
+    """
+    if not os.path.exists(manifest_f):
+        return None
+    manifest_h = open(manifest_f, 'rb')
+    try:
+        layout = json.load(manifest_h).get('settings', {}).get('layout')
+    except ValueError:
+        return None
+    finally:
+        manifest_h.close()
+    if not layout or layout[0] != cores:
+        return None
+    return tuple(layout[1:])
+
+def save_manifest(manifest_f, settings, chunks):
+    "writes the run settings and chunk records to manifest_f, replacing it atomically"
+    manifest_h = open(manifest_f + '.tmp', 'wb')
+    json.dump({'settings':settings, 'chunks':chunks}, manifest_h, indent=1, sort_keys=True)
+    manifest_h.close()
+    os.rename(manifest_f + '.tmp', manifest_f)
+
+def manifest_outputs(manifest_f, filepref):
+    """
+    returns the output files of the run recorded in manifest_f, in the order blast_pool
+    merges them (for each database shard, the cached hits if the run used a cache, then
+    the output of each chunk), and the run's settings. Raises ValueError if there is no
+    manifest, or if any chunk did not complete.
+    """
+    if not os.path.exists(manifest_f):
+        raise ValueError("%s not found" % manifest_f)
+    manifest_h = open(manifest_f, 'rb')
+    try:
+        manifest = json.load(manifest_h)
+    finally:
+        manifest_h.close()
+    settings = manifest['settings']
+    chunks = { int(t):chunk for t, chunk in manifest['chunks'].items() }
+    incomplete = [ t for t in chunks if chunks[t].get('status') != 'complete' ]
+    if incomplete:
+        raise ValueError("%d searches in %s did not complete" % (len(incomplete),
+                                                                  manifest_f))
+
+    outfiles = []
+    for s in range(settings.get('shards') or 1):
+        shard = '.%d' % s if settings.get('shards') else ''
+        if 'cached' + shard in settings:
+            outfiles.append(filepref + '.cached' + shard + '.blastp.tsv')
+        for t in sorted(chunks):
+            # chunk outputs are named <filepref>.<chunk><shard>.blastp.tsv:
+            out_f = chunks[t]['output']
+            if out_f[len(filepref):-len('.blastp.tsv')].split('.')[2:] == shard.split('.')[1:]:
+                outfiles.append(out_f)
+    return outfiles, settings
+
+def chunk_complete(chunk, query_md5, out_f):
+    """
+    checks that a chunk recorded as complete in the manifest still has the same query
+    sequences, and an output file that has not changed since the chunk finished.
+    """
+    return (    chunk.get('status') == 'complete'
+            and os.path.exists(out_f)
+            and chunk.get('query_md5') == query_md5
+            and chunk.get('output_md5') == file_md5(out_f) )
+
+class SearchOptions(object):
+    """
+    how blast_pool runs and merges its searches:
+      blastype           the blast program
+      numprocs, threads  blast processes run at once, and threads for each
+      numhits, rank_by   hits kept per query, and how they are ranked (see top_hits)
+      cache_f            sqlite cache of hits (see open_cache)
+      shards, dbsize     database shards and their total letters (see shard_database)
+      progress           seconds between progress reports (see ProgressMonitor)
+      schedule           the order searches are started in (see schedule_jobs)
+    """
+    def __init__(self, blastype='blastp', numprocs=1, threads=1, numhits=None,
+                 rank_by='bitscore', cache_f=None, shards=None, dbsize=None,
+                 progress=None, schedule='longest'):
+        self.blastype = blastype
+        self.numprocs = numprocs
+        self.threads = threads
+        self.numhits = numhits
+        self.rank_by = rank_by
+        self.cache_f = cache_f
+        self.shards = shards
+        self.dbsize = dbsize
+        self.progress = progress
+        self.schedule = schedule
+
+def blast_pool(fasta_mm, chunks, database, filepref, order=None, duplicates=None,
+                settings=None, options=None):
+    """
+    searches each chunk of indexed records (see chunk_records) against database (or each
+    of its shards) with the SearchOptions options, streaming the records to blast's
+    stdin. Completed searches are recorded in <filepref>.manifest.json and not rerun
+    with the same settings; timings go to <filepref>.timing.json. If all searches
+    succeed, their outputs are merged (see merge_results) into <filepref>.blastp.tsv.
+    Returns the merged file name (None if any search failed) and the failed searches.
+    """
+    if options is None:
+        options = SearchOptions()
+    blastype, numprocs, threads = options.blastype, options.numprocs, options.threads
+    numhits, rank_by, cache_f = options.numhits, options.rank_by, options.cache_f
+    shards, dbsize = options.shards, options.dbsize
+    progress, schedule = options.progress, options.schedule
+
+    if settings is None:
+        settings = {}
+    settings = dict(settings, database=database, blastype=blastype)
+    if shards:
+        databases = shards
+        settings.update(shards=len(shards), dbsize=dbsize)
+    else:
+        databases = [database]
+
+    tasks = [] # (database, chunk, cache key prefix, output file) for every search
+    outfiles = []
+    for s, db in enumerate(databases):
+        db_chunks = chunks
+        namespace = None
+        shard = '.%d' % s if shards else ''
+        if cache_f:
+            cache_db, namespace = open_cache(cache_f, db,
+                                             blast_command('-', db, '', blastype, dbsize))
+            db_chunks, cached = split_cached(cache_db, namespace, chunks)
+            outfiles.append(filepref + '.cached' + shard + '.blastp.tsv')
+            write_cached(cache_db, namespace, cached, outfiles[-1])
+            settings['cached' + shard] = len(cached)
+        for f, chunk in enumerate(db_chunks):
+            tasks.append((db, chunk, namespace,
+                          '%s.%d%s.blastp.tsv' % (filepref, f, shard)))
+
+    settings['numfiles'] = len(tasks)
+    manifest_f = filepref + '.manifest.json'
+    manifest = load_manifest(manifest_f, settings)
+    jobs = []
+    for t, (db, chunk, namespace, out_f) in enumerate(tasks):
+        outfiles.append(out_f)
+        ranges = record_ranges(chunk)
+        query_md5 = ranges_md5(fasta_mm, ranges)
+        if t in manifest and chunk_complete(manifest[t], query_md5, out_f):
+            continue
+        manifest[t] = {'queries':len(chunk), 'query_md5':query_md5, 'database':db,
+                       'output':out_f, 'output_md5':None, 'status':'pending'}
+        jobs.append((t, blast_command('-', db, out_f, blastype, dbsize, threads),
+                     partial(feed_ranges, fasta_mm=fasta_mm, ranges=ranges)))
+    save_manifest(manifest_f, settings, manifest)
+
+    # shards are balanced by letters, so each holds about 1/len(shards) of the database:
+    db_letters = 1.0 * dbsize / len(shards) if shards else 1
+    costs = { t:sum( r[3] for r in tasks[t][1] ) * db_letters for t, cmd, feed in jobs }
+    jobs, schedule_log = schedule_jobs(jobs, costs, numprocs, schedule)
+
+    monitor = ProgressMonitor({ t:(tasks[t][3], len(tasks[t][1]),
+                                   sum( r[3] for r in tasks[t][1] ))
+                                for t, cmd, feed in jobs }, progress)
+    if progress:
+        monitor.start()
+
+    def record_search(t, returncode, stderr):
+        monitor.finished(t, returncode)
+        if returncode == 0:
+            manifest[t].update(status='complete',
+                               output_md5=file_md5(manifest[t]['output']))
+            if cache_f:
+                db, chunk, namespace, out_f = tasks[t]
+                store_hits(cache_db, namespace, chunk, out_f)
+        else:
+            manifest[t].update(status='failed', exit_code=returncode)
+        save_manifest(manifest_f, settings, manifest)
+
+    results = run_pool(jobs, numprocs, on_finish=record_search,
+                       on_start=monitor.started)
+    if progress:
+        monitor.stop()
+    monitor.summary(filepref + '.timing.json',
+                    dict(settings, numprocs=numprocs, threads=threads),
+                    schedule_log)
+    failed = { t:results[t] for t in results if results[t][0] != 0 }
+    if failed:
+        return None, failed
+
+    merged_f = filepref + '.blastp.tsv'
+    merge_results(outfiles, merged_f, order, duplicates, numhits, rank_by,
+                  rerank=bool(shards))
+    return merged_f, failed
 
 
 
@@ -63,12 +1084,70 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Speeds up all v all blastp search")
 
     # input options
-    parser.add_argument("-I", "--input_file", type=str, help="The peptide fasta file (query file)")
+    parser.add_argument("-I", "--input_file", type=str,
+                        help="The peptide fasta file (query file), optionally gzipped")
     parser.add_argument("-D", "--database", type=str, help="The blast database to use (target db)")
     parser.add_argument("-b", "--blast_type", type=str, default='blastp',
                         help="The blast algorithm to use. (default = blastp)")
     parser.add_argument("-p", "--num_threads", type=int, default=1,
                         help="number of threads to distribute blast over")
+    parser.add_argument("-s", "--split_by", type=str, default='sequences',
+                        choices=['sequences', 'residues'],
+                        help="""balance the split files by number of sequences or by total
+                        number of residues (default = sequences)""")
+    parser.add_argument("-w", "--wait", action='store_true', default=False,
+                        help="""run blast as a managed pool: wait for every chunk to
+                        finish, report any failures and merge the results into one file""")
+    parser.add_argument("-B", "--batches", type=int,
+                        help="""with --wait, split the query into this many batches, which
+                        the blast processes take in turn until all are searched
+                        (default = %d per blast process)""" % BATCHES_PER_PROCESS)
+    parser.add_argument("-u", "--unique", action='store_true', default=False,
+                        help="""with --wait, search each distinct sequence only once and
+                        copy its hits to every identical sequence in the merged results""")
+    parser.add_argument("-n", "--top_hits", type=int,
+                        help="""only keep this many hits per query in the merged results""")
+    parser.add_argument("-r", "--rank_by", type=str, default='bitscore',
+                        choices=['bitscore', 'evalue'],
+                        help="""how to choose the best hits for --top_hits
+                        (default = bitscore)""")
+    parser.add_argument("-c", "--cache", type=str,
+                        help="""with --wait, a sqlite file of previous blast hits. Queries
+                        whose sequence has already been searched against the same database
+                        with the same settings are answered from it, and new hits are
+                        added to it""")
+    parser.add_argument("-S", "--db_shards", type=int,
+                        help="""with --wait, also split the database into this many shards
+                        and search every batch against every shard. E-values are
+                        calculated for the size of the whole database""")
+    parser.add_argument("-P", "--progress", type=int,
+                        help="""with --wait, report progress, ETA and straggling searches
+                        every this many seconds""")
+    parser.add_argument("--schedule", type=str, default='longest',
+                        choices=['longest', 'input'],
+                        help="""with --wait, start the batches with the most residues first
+                        (longest) or in input order (default = longest)""")
+    parser.add_argument("-t", "--search_threads", type=int, default=1,
+                        help="""with --wait, the number of threads each blast process uses.
+                        num_threads / search_threads processes are run at once
+                        (default = 1)""")
+    parser.add_argument("-A", "--autotune", action='store_true', default=False,
+                        help="""with --wait, time a sample of queries to find the split of
+                        num_threads into processes x search_threads that is fastest""")
+    parser.add_argument("--tune_sample", type=int, default=200,
+                        help="""number of queries to time for --autotune (default = 200)""")
+    parser.add_argument("-k", "--prefilter", type=int,
+                        help="""with --wait, do not search queries that share no k-mer of
+                        this length with the database. The skipped query ids are saved to
+                        <input>.skipped.txt. Best used when the query set is not also the
+                        database. 5 is a reasonable length for proteins""")
+    parser.add_argument("-R", "--rbh", action='store_true', default=False,
+                        help="""after merging, save the reciprocal best hits of the all v all
+                        search to <input>.rbh.tsv""")
+    parser.add_argument("-m", "--merge_only", action='store_true', default=False,
+                        help="""do not run blast. Merge the outputs of the last -w run
+                        (as listed in <input>.manifest.json) in query order into
+                        <input>.blastp.tsv""")
 
     args = parser.parse_args()
 
@@ -81,12 +1160,106 @@ if __name__ == '__main__':
     # parse database path:
     dbfull   = os.path.realpath(args.database)
     # parse blast output name and dir:
-    filepref = os.path.splitext(fullname)[0]
+    filepref = fasta_prefix(fullname)
+
+    if args.wait and args.batches:
+        numfiles = args.batches
+    else:
+        numfiles = args.num_threads
+
+    if args.merge_only:
+        try:
+            outfiles, settings = manifest_outputs(filepref + '.manifest.json', filepref)
+        except ValueError as e:
+            print "cannot merge results: %s" % (e)
+            sys.exit(1)
+        print "merging %d result files..." % (len(outfiles))
+        # merge as the run was searched, whatever the flags given now:
+        records, order, duplicates = index_fasta(open_fasta(fullname, args.num_threads),
+                                                 dedup=settings.get('unique', False))
+        merge_results(outfiles, filepref + '.blastp.tsv', order, duplicates,
+                      numhits=args.top_hits, rank_by=args.rank_by,
+                      rerank=bool(settings.get('shards')))
+        print "merged results saved as %s.blastp.tsv" % (filepref)
+        merged_f = filepref + '.blastp.tsv'
+    elif args.wait:
+        print "indexing %s..." % (filename)
+        fasta_mm = open_fasta(fullname, args.num_threads)
+        records, order, duplicates = index_fasta(fasta_mm, dedup=args.unique)
+        if duplicates:
+            print "%d duplicate sequences will not be searched" % (
+                                            sum( len(d) for d in duplicates.values() ))
+        if args.prefilter:
+            print "finding queries with no %d-mer in %s..." % (args.prefilter, args.database)
+            records, skipped = prefilter_records(fasta_mm, records,
+                                                 kmer_table(dbfull, args.prefilter),
+                                                 args.prefilter)
+            skipped_h = open(filepref + '.skipped.txt', 'w')
+            for r in skipped:
+                skipped_h.write("\n".join([r[0]] + duplicates.get(r[0], [])) + "\n")
+            skipped_h.close()
+            print "%d queries skipped. ids saved as %s.skipped.txt" % (len(skipped),
+                                                                        filepref)
+
+        if args.db_shards:
+            print "splitting %s into %d shards..." % (args.database, args.db_shards)
+            shards, dbsize = shard_database(dbfull, args.db_shards, args.blast_type)
+        else:
+            shards, dbsize = None, None
+
+        settings = {'split_by':args.split_by, 'unique':args.unique}
+        if args.autotune:
+            # reuse the layout of an earlier run, so that it is chunked the same way:
+            layout = tuned_layout(filepref + '.manifest.json', args.num_threads)
+            if layout:
+                numprocs, threads = layout
+                print "using %d processes x %d threads, as tuned by the last run" % (
+                                                                    numprocs, threads)
+            else:
+                print "timing %d queries for each split of %d threads..." % (
+                                                    min(args.tune_sample, len(records)),
+                                                    args.num_threads)
+                (numprocs, threads), speeds = calibrate_layout(fasta_mm, records,
+                                                    shards[0] if shards else dbfull,
+                                                    args.num_threads, args.blast_type,
+                                                    dbsize, args.tune_sample)
+                for layout in sorted(speeds):
+                    print "  %d processes x %d threads: %.0f residues/s" % (layout + (
+                                                                    speeds[layout],))
+                print "using %d processes x %d threads" % (numprocs, threads)
+            settings['layout'] = [args.num_threads, numprocs, threads]
+        else:
+            threads = max(1, min(args.search_threads, args.num_threads))
+            numprocs = args.num_threads // threads
+        if not args.batches:
+            numfiles = numprocs * BATCHES_PER_PROCESS
 
-    print "splitting %s into %d files..." % (filename, args.num_threads)
-    split_fasta(fullname, args.num_threads)
-    print "split fasta files saved in dir: %s" % (filepath)
-    print "running blastp for all files"
-    print "results saved as %s.##.blastp.tsv" % (filepref)
-    blastall(fullname, args.num_threads, dbfull, blastype=args.blast_type)
+        chunks = chunk_records(records, numfiles, balance=args.split_by)
+        print "running %s for %d sequences in %d batches" % (args.blast_type,
+                                                            len(records), len(chunks))
+        options = SearchOptions(blastype=args.blast_type, numprocs=numprocs,
+                                threads=threads, numhits=args.top_hits,
+                                rank_by=args.rank_by, cache_f=args.cache, shards=shards,
+                                dbsize=dbsize, progress=args.progress,
+                                schedule=args.schedule)
+        merged_f, failed = blast_pool(fasta_mm, chunks, dbfull, filepref, order=order,
+                                      duplicates=duplicates, settings=settings,
+                                      options=options)
+        for f in sorted(failed):
+            print "search %d failed with exit code %d:" % (f, failed[f][0])
+            print failed[f][1].strip()
+        if failed:
+            print "%d searches failed. Results were not merged." % (len(failed))
+            sys.exit(1)
+        print "all searches complete. merged results saved as %s" % (merged_f)
+    else:
+        print "splitting %s into %d files..." % (filename, numfiles)
+        split_fasta(fullname, numfiles, balance=args.split_by, threads=args.num_threads)
+        print "split fasta files saved in dir: %s" % (filepath)
+        print "running blastp for all files"
+        print "results saved as %s.##.blastp.tsv" % (filepref)
+        blastall(fullname, args.num_threads, dbfull, blastype=args.blast_type)
 
+    if args.rbh and (args.merge_only or args.wait):
+        pairs = reciprocal_best_hits(merged_f, filepref + '.rbh.tsv')
+        print "%d reciprocal best hit pairs saved as %s.rbh.tsv" % (pairs, filepref)
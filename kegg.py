@@ -4,16 +4,101 @@ A python module for dealing with KEGG pathways and orthologs
 """
 
 import re
+import os
 import sys
+import gc
+import hashlib
+import marshal
 
 from itertools import chain
 import argparse
 
+import numpy as np
+import scipy.sparse as sparse
+
 from genomepy import config
 
 
 class KeggTree(object):
-    def __init__(self, kegg_f, cbir_ko):
+    # the attributes saved in a snapshot of the parsed tree. Change snapshot_version
+    # whenever these (or the parsing) change, so that old snapshots are rebuilt.
+    snapshot_attrs = ('top_trees', 'pathway_groups', 'pathway_groups_rev',
+                      'pathway_groups_keggs_rev', 'pathways', 'pathways_rev',
+                      'pathways_terms', 'kegg_terms', 'cbir_dic')
+    snapshot_version = 6
+
+    def __init__(self, kegg_f, cbir_ko, use_cache=True):
+        """
+        builds the tree from the KEGG hierarchy (.keg) file and the gene - KEGG ortholog
+        list. If use_cache is True, the parsed tree is loaded from a snapshot beside the
+        hierarchy file, which is rebuilt whenever either file's size or modification
+        time changes.
+        """
+        self.term_index = None  # built by the first search (see build_term_index)
+        self.gene_pathway = None  # built when first used (see build_incidence)
+
+        if use_cache:
+            snapshot_f, key = self.snapshot_key(kegg_f, cbir_ko)
+            if self.load_snapshot(snapshot_f, key):
+                return
+
+        self.parse(kegg_f, cbir_ko)
+
+        if use_cache:
+            self.save_snapshot(snapshot_f, key)
+
+    def snapshot_key(self, kegg_f, cbir_ko):
+        "returns the snapshot file name and the key identifying the source files"
+        key = [self.snapshot_version]
+        for source_f in (kegg_f, cbir_ko):
+            stat = os.stat(source_f)
+            key.append((os.path.realpath(source_f), stat.st_size, stat.st_mtime))
+        snapshot_f = "%s.%s.snapshot" % (kegg_f,
+                            hashlib.md5(os.path.realpath(cbir_ko)).hexdigest()[:8])
+        return snapshot_f, key
+
+    def load_snapshot(self, snapshot_f, key):
+        """
+        loads the tree from snapshot_f if it was made from the same source files. The
+        snapshot holds only the parsed dictionaries of strings and lists, stored with
+        marshal, which reads them back much faster than parsing (and, unlike pickle,
+        cannot run code). The garbage collector is paused while the many small lists
+        are created.
+        """
+        if not os.path.exists(snapshot_f):
+            return False
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            handle = open(snapshot_f, 'rb')
+            try:
+                snapshot_key, values = marshal.load(handle)
+            finally:
+                handle.close()
+            if snapshot_key != key or len(values) != len(self.snapshot_attrs):
+                return False
+        except Exception:
+            return False # a damaged or foreign snapshot is rebuilt by parsing again
+        finally:
+            if gc_enabled:
+                gc.enable()
+        for attr, value in zip(self.snapshot_attrs, values):
+            setattr(self, attr, value)
+        return True
+
+    def save_snapshot(self, snapshot_f, key):
+        "saves the parsed tree to snapshot_f"
+        values = [ getattr(self, attr) for attr in self.snapshot_attrs ]
+        try:
+            handle = open(snapshot_f + '.tmp', 'wb')
+            marshal.dump((key, values), handle, 2)
+            handle.close()
+            os.rename(snapshot_f + '.tmp', snapshot_f)
+        except (IOError, OSError):
+            pass # the hierarchy's directory is read-only, so parse again next time
+
+    def parse(self, kegg_f, cbir_ko):
+        "parses the KEGG hierarchy file and the gene - KEGG ortholog list"
         self.top_trees = {}                 # A level
         self.pathway_groups = {}            # B level
         self.pathway_groups_rev = {}        # B level
@@ -84,6 +169,7 @@ class KeggTree(object):
                         self.pathway_groups_keggs_rev[currentD] += [currentB]
                     else:
                         self.pathway_groups_keggs_rev[currentD] = [currentB]
+        handle.close()
 
     def convert_kegg(self, kegg):
         try:
@@ -148,7 +234,151 @@ class KeggTree(object):
             idtype = 'kegg'
         return idname, idtype
 
+    def build_term_index(self):
+        """
+        builds an inverted index of the text searched by search_terms. For each level
+        (keggs, pathways, pathway_groups and top_level) the ids and their text are listed,
+        and every 3 character substring (trigram) of the text is mapped to the positions
+        of the ids whose text contains it. This is done by the first search, not when
+        the tree is loaded.
+        """
+        sources = { 'keggs':self.kegg_terms.items(),
+                    'pathways':self.pathways_terms.items(),
+                    'pathway_groups':[ (g, g) for g in self.pathway_groups ],
+                    'top_level':[ (t, t) for t in self.top_trees ] }
+        self.term_index = {}
+        for level, items in sources.items():
+            postings = {}
+            for pos, (id, text) in enumerate(items):
+                for trigram in set( text[i:i+3] for i in range(len(text) - 2) ):
+                    if trigram in postings:
+                        postings[trigram].append(pos)
+                    else:
+                        postings[trigram] = [pos]
+            self.term_index[level] = ( [ id for id, text in items ],
+                                       [ text for id, text in items ],
+                                       postings )
+
+    def build_incidence(self):
+        """
+        builds sparse incidence matrices of KEGG orthologs x pathways (ko_pathway), genes x
+        KEGG orthologs (gene_ko) and genes x pathways (gene_pathway), each entry being 1
+        if the row is a member of the column. Rows and columns are in sorted id order, so
+        the index maps are stable for a given pair of source files: ko_ids, gene_ids and
+        pathway_ids list the ids of each position, and ko_index, gene_index and
+        pathway_index give the position of each id. Nothing is built when the tree is
+        loaded: the methods below build the matrices when first called, and code reading
+        them directly should call build_incidence first.
+        """
+        self.ko_ids = sorted(self.kegg_terms)
+        self.gene_ids = sorted(set(chain.from_iterable(self.cbir_dic.values())))
+        self.pathway_ids = sorted(self.pathways)
+        self.ko_index = { ko:i for i, ko in enumerate(self.ko_ids) }
+        self.gene_index = { g:i for i, g in enumerate(self.gene_ids) }
+        self.pathway_index = { p:i for i, p in enumerate(self.pathway_ids) }
+
+        pairs = [ (self.ko_index[ko], self.pathway_index[p])
+                    for p in self.pathways for ko in self.pathways[p] ]
+        self.ko_pathway = incidence_matrix(pairs, len(self.ko_ids), len(self.pathway_ids))
+
+        pairs = [ (self.gene_index[g], self.ko_index[ko])
+                    for ko in self.cbir_dic if ko in self.ko_index
+                    for g in self.cbir_dic[ko] ]
+        self.gene_ko = incidence_matrix(pairs, len(self.gene_ids), len(self.ko_ids))
+
+        self.gene_pathway = (self.gene_ko * self.ko_pathway).tocsr()
+        self.gene_pathway.data[:] = 1
+
+    def pathway_members(self, pathways, genes=True):
+        """
+        returns a dictionary of pathway:[members] for a list of pathways, read from the
+        columns of the gene (or, if genes is False, KEGG ortholog) x pathway matrix. Unlike
+        list_keggs(convert=True), each gene is listed once per pathway.
+        """
+        if self.gene_pathway is None:
+            self.build_incidence()
+        if genes:
+            matrix, ids = self.gene_pathway, self.gene_ids
+        else:
+            matrix, ids = self.ko_pathway, self.ko_ids
+        columns = [ self.pathway_index[p] for p in pathways if p in self.pathway_index ]
+        submatrix = matrix[:, columns].tocsc()
+        members = { p:[] for p in pathways }
+        for col, i in enumerate(columns):
+            rows = submatrix.indices[submatrix.indptr[col]:submatrix.indptr[col + 1]]
+            members[self.pathway_ids[i]] = [ ids[r] for r in sorted(rows) ]
+        return members
+
+    def pathway_counts(self, genes):
+        """
+        returns an array of the number of genes in the list that belong to each pathway
+        (in pathway_ids order), alongside an array of the total number of genes in each
+        pathway, as used for enrichment tests.
+        """
+        if self.gene_pathway is None:
+            self.build_incidence()
+        selected = np.zeros(len(self.gene_ids), dtype=np.int32)
+        selected[[ self.gene_index[g] for g in set(genes) if g in self.gene_index ]] = 1
+        hits = np.asarray(self.gene_pathway.T.dot(selected)).ravel()
+        totals = np.asarray(self.gene_pathway.sum(axis=0)).ravel()
+        return hits, totals
+
+    def save_incidence(self, prefix):
+        """
+        saves the gene x pathway and KEGG ortholog x pathway matrices to
+        <prefix>.gene_pathway.npz and <prefix>.ko_pathway.npz, and their row and column
+        ids to <prefix>.genes.txt, <prefix>.keggs.txt and <prefix>.pathways.txt
+        """
+        if self.gene_pathway is None:
+            self.build_incidence()
+        sparse.save_npz(prefix + '.gene_pathway.npz', self.gene_pathway)
+        sparse.save_npz(prefix + '.ko_pathway.npz', self.ko_pathway)
+        for ids, name in ((self.gene_ids, 'genes'), (self.ko_ids, 'keggs'),
+                          (self.pathway_ids, 'pathways')):
+            handle = open("%s.%s.txt" % (prefix, name), 'w')
+            handle.write("".join( "%s\n" % id for id in ids ))
+            handle.close()
+
+    def search_many(self, searchstrings):
+        """
+        searches the KEGG terms for each of a list of search strings, returning a
+        dictionary of searchstring:results, where results are as for search_terms. Plain
+        strings of 3 or more characters are looked up in the trigram index: the ids
+        holding all of the string's trigrams are the only candidates, and are checked
+        for the whole string. Other strings are treated as regular expressions and
+        searched for in every term.
+        """
+        if self.term_index is None:
+            self.build_term_index()
+        all_results = {}
+        for searchstring in searchstrings:
+            results = {}
+            for level, (ids, texts, postings) in self.term_index.items():
+                if len(searchstring) < 3 or set(searchstring) & set(".^$*+?{}[]\\|()"):
+                    pattern = re.compile(searchstring)
+                    results[level] = [ ids[p] for p in range(len(ids))
+                                            if pattern.search(texts[p]) ]
+                    continue
+
+                trigrams = set( searchstring[i:i+3] for i in range(len(searchstring) - 2) )
+                if not trigrams <= set(postings):
+                    results[level] = []
+                    continue
+                trigrams = sorted(trigrams, key=lambda t: len(postings[t]))
+                candidates = set(postings[trigrams[0]])
+                for trigram in trigrams[1:]:
+                    candidates.intersection_update(postings[trigram])
+                results[level] = [ ids[p] for p in sorted(candidates)
+                                        if searchstring in texts[p] ]
+            all_results[searchstring] = results
+        return all_results
+
     def search_terms(self, searchstring):
+        "returns the keggs, pathways, pathway groups and top levels matching searchstring"
+        return self.search_many([searchstring])[searchstring]
+
+    def scan_terms(self, searchstring):
+        "as search_terms, but searching every term with re.search instead of the index"
         results = {'keggs':[],'pathways':[],'pathway_groups':[],'top_level':[]}
         for kegg,term in self.kegg_terms.items():
             termsearch = re.search(searchstring,term)
@@ -178,6 +408,9 @@ def define_arguments():
                         help="specify the directory to save results to")
     parser.add_argument("-q", "--quiet", action='store_true',default=False,
                         help="don't print messages")
+    parser.add_argument("--no_cache", action='store_true', default=False,
+                        help="""reparse the KEGG files instead of loading the snapshot
+                        saved beside the hierarchy file""")
 
     # input options:
     parser.add_argument("-k", "--listkeggs", type=str,
@@ -193,6 +426,9 @@ def define_arguments():
                         help="search pathways for match to string")
     parser.add_argument("-l", "--level", type=str,
                         help="level for pathway search (A, B or C)")
+    parser.add_argument("--incidence", action='store_true', default=False,
+                        help="""save the sparse gene x pathway and KEGG ortholog x
+                        pathway matrices, with their row and column ids""")
 
     parser.add_argument("kegg_hierarchy", nargs=1,
                         help="""the KEGG hierarchy file.""")
@@ -213,8 +449,20 @@ def cbir_tree(cbir_ko):
                 cbir_dic[cols[1]] += [cols[0]]
             else:
                 cbir_dic[cols[1]] = [cols[0]]
+    handle.close()
     return cbir_dic
 
+def incidence_matrix(pairs, rows, cols):
+    "returns a rows x cols sparse (CSR) matrix with a 1 at each (row, column) in pairs"
+    if pairs:
+        row, col = zip(*pairs)
+    else:
+        row, col = (), ()
+    matrix = sparse.coo_matrix((np.ones(len(row), dtype=np.int32), (row, col)),
+                               shape=(rows, cols)).tocsr()
+    matrix.data[:] = 1  # duplicate pairs are summed when converting to CSR
+    return matrix
+
 def load_config(config_f):
     config_h = open(config_f, 'rb')
     config_d = { line.split()[0]:line.split()[1] for line in config_h if line[0]!='#'}
@@ -234,7 +482,7 @@ if __name__ == '__main__':
     verbalise = config.check_verbose(not(args.quiet))
     logfile = config.create_log(args, outdir=args.directory, outname=args.output)
 
-    kegg_tree = KeggTree(kegg_f, cbir_ko)
+    kegg_tree = KeggTree(kegg_f, cbir_ko, use_cache=not args.no_cache)
 
 
     #print "top_trees\n", kegg_tree.top_trees.items()[:5]                 # A level
@@ -274,11 +522,11 @@ if __name__ == '__main__':
 
     if args.search:
         print args.search.split(",")
-        for searchterm in args.search.split(","):
-            if searchterm == "":
-                continue
+        searchterms = [ s for s in args.search.split(",") if s != "" ]
+        all_results = kegg_tree.search_many(searchterms)
+        for searchterm in searchterms:
             print searchterm
-            results = kegg_tree.search_terms(searchterm)
+            results = all_results[searchterm]
             for level in results:
                 verbalise("M", level)
                 if level == "pathways":
@@ -293,6 +541,12 @@ if __name__ == '__main__':
                 else:
                     verbalise("C", "\n".join(results[level]))
 
+    if args.incidence:
+        prefix = logfile[:-4]
+        kegg_tree.save_incidence(prefix)
+        verbalise("M", "saved %d gene x %d pathway matrix to %s.gene_pathway.npz" %
+                        (len(kegg_tree.gene_ids), len(kegg_tree.pathway_ids), prefix))
+
     if args.define:
         kos = args.define.split(',')
         for ko in kos: